@@ -14,6 +14,10 @@ from wx.lib.masked import numctrl       #For cells that only take floats
 import wx.lib.scrolledpanel             #Setup scrollbar for the main panel if it is too large
 
 import random
+import struct
+import array
+import sys
+import os
 
 GRAIL = True
 
@@ -36,6 +40,110 @@ VERSION = "1.0 Build %s" % REVISION
 
 DEPOSIT = ['blob', 'tabular', 'tab(tilted)', 'vein']
 
+#Compact block model file (run-length encoded columns along z)
+RLE_MAGIC = 'RMBM'
+RLE_VERSION = 1
+RLE_HEADER = '<4sHhIIII'    #magic, version, precision, rows, cols, lvls, number of runs
+RLE_COUNT = 'I'             #run lengths, little endian uint32
+RLE_VALUE = 'd'             #run values, little endian double
+
+def matrix_to_csv(matrix, fileName, region=None):
+    '''Write the matrix to a CSV file (col, row, lvl, value on each line).
+    region (min_row, max_row, min_col, max_col, min_lvl, max_lvl) limits the output to a sub-volume.'''
+    if region is None:
+        region = (0, len(matrix), 0, len(matrix[0]), 0, len(matrix[0][0]))
+    csv = open(fileName, 'w')
+    for row_idx in xrange(region[0], region[1]):
+        row = matrix[row_idx]
+        for col_idx in xrange(region[2], region[3]):
+            col = row[col_idx]
+            for lvl_idx in xrange(region[4], region[5]):
+                csv.write('%s,%s,%s,%0.3f\n' %(col_idx+1, row_idx+1, lvl_idx+1, col[lvl_idx]))
+    csv.close()
+
+def read_rle_runs(fileName='model.rbm'):
+    '''Read the header and runs of a compact model file written by CreateModel.write_matrix_rle.
+    Returns a header dictionary and the arrays of run lengths and run values.'''
+    rle = open(fileName, 'rb')
+    data = rle.read()
+    rle.close()
+
+    header_size = struct.calcsize(RLE_HEADER)
+    if len(data) < header_size:
+        raise ValueError("%s is not a compact model file (only %s bytes)" %(fileName, len(data)))
+    magic, version, precision, rows, cols, lvls, runs = struct.unpack_from(RLE_HEADER, data)
+    if magic != RLE_MAGIC:
+        raise ValueError("%s is not a compact model file" %fileName)
+    if version != RLE_VERSION:
+        raise ValueError("%s has compact model file version %s, expected %s" %(fileName, version, RLE_VERSION))
+    header = {'rows': rows, 'cols': cols, 'lvls': lvls, 'precision': precision, 'runs': runs}
+
+    #All run lengths are stored first, followed by all run values
+    counts = array.array(RLE_COUNT)
+    values = array.array(RLE_VALUE)
+    values_start = header_size + runs*counts.itemsize
+    expected = values_start + runs*values.itemsize
+    if len(data) != expected:
+        raise ValueError("%s has %s bytes, expected %s for %s runs" %(fileName, len(data), expected, runs))
+    counts.fromstring(data[header_size:values_start])
+    values.fromstring(data[values_start:])
+    if sys.byteorder != 'little':
+        counts.byteswap()
+        values.byteswap()
+    return header, counts, values
+
+def iter_rle_runs(header, counts, values, fileName='model.rbm'):
+    '''Walk the runs of a compact model file in row, col, lvl order.
+    Yields (row, col, lvl, count, value) for each run, with lvl being the first level of the run.'''
+    rows, cols, lvls, precision = header['rows'], header['cols'], header['lvls'], header['precision']
+    row = col = lvl = 0
+    for idx in xrange(header['runs']):
+        count = counts[idx]
+        if row >= rows:
+            raise ValueError("%s has runs past the end of the model" %fileName)
+        if count == 0 or lvl + count > lvls:
+            raise ValueError("%s run %s crosses a column boundary at row %s, col %s" %(fileName, idx, row+1, col+1))
+        yield row, col, lvl, count, round(values[idx], precision)
+        lvl += count
+        if lvl == lvls:
+            lvl = 0
+            col += 1
+            if col == cols:
+                col = 0
+                row += 1
+
+    if row != rows or col or lvl:
+        raise ValueError("%s is truncated: found %s of %s rows" %(fileName, row, rows))
+
+def read_matrix_rle(fileName='model.rbm'):
+    '''Read a compact model file written by CreateModel.write_matrix_rle.
+    Returns a header dictionary and the matrix as nested lists [row][col][lvl].'''
+    header, counts, values = read_rle_runs(fileName)
+
+    matrix = []
+    column = []
+    row_list = []
+    for row, col, lvl, count, value in iter_rle_runs(header, counts, values, fileName):
+        column.extend([value] * count)
+        if len(column) == header['lvls']:
+            row_list.append(column)
+            column = []
+            if len(row_list) == header['cols']:
+                matrix.append(row_list)
+                row_list = []
+    return header, matrix
+
+def convert_rle_to_csv(rle_name='model.rbm', csv_name='model.txt'):
+    '''Convert a compact model file to the CSV layout used by write_matrix_csv.
+    Runs are written out as they are decoded so the expanded model is never held in memory.'''
+    header, counts, values = read_rle_runs(rle_name)
+    csv = open(csv_name, 'w')
+    for row, col, lvl, count, value in iter_rle_runs(header, counts, values, rle_name):
+        for lvl_idx in xrange(lvl, lvl+count):
+            csv.write('%s,%s,%s,%0.3f\n' %(col+1, row+1, lvl_idx+1, value))
+    csv.close()
+    return header
+
 class CreateModel(): 
     def __init__(self, row, col, lvl, seed_number, cutoff=0.15, average=1, noise=0.1, min_blocks=0, max_blocks=10, precision=3, deposit = 'blob'):
         
@@ -105,6 +213,7 @@ class CreateModel():
     def determine_seeds(self, row, col, lvl, seed_number):
         '''Determine location and values for seeds'''
         self.seeds = []
+        self.seed_blocks = []
         count = 1
         
         #Create seed locations in model
@@ -118,21 +227,10 @@ class CreateModel():
                 y = random.randint(0,col-1)
                 z = random.randint(0,lvl-1)
 
-            self.pref_d, self.opp_d = self.anisotropy()
-            
             #Append new seed to list
-            current_seed = [x,y,z]
+            self.claim_start(len(self.seeds), x, y, z)
             self.seeds.append([x,y,z])
-            
-            #Generate random gaussian value for seed
-            self.seed_value = round(random.gauss(self.average,self.noise),self.precision)
-            
-            #Add seed and value to matrix
-            self.matrix[x][y][z] = self.seed_value
-            self.block_count = 1
-            
-            #Find neighbors for seed
-            self.check_blocks([[current_seed]])
+            self.seed_blocks.append(self.grow_seed(x, y, z))
             
             #Write to report
             self.summary += "Seed %s value: %s\n" %(count,self.seed_value)
@@ -145,6 +243,135 @@ class CreateModel():
         self.summary +=  "Total blocks coded: %s\n" %self.total_blocks
         #print "\nNEW Matrix:\n",  self.print_matrix()   #REPORT MATRIX VALUES
 
+    def grow_seed(self, x, y, z):
+        '''Code a seed at x, y, z and grow it. Returns every block the seed touched (coded or -2).'''
+        self.pref_d, self.opp_d = self.anisotropy()
+        current_seed = [x,y,z]
+        self.touched = [current_seed]
+        
+        #Generate random gaussian value for seed
+        self.seed_value = round(random.gauss(self.average,self.noise),self.precision)
+        
+        #Add seed and value to matrix
+        self.matrix[x][y][z] = self.seed_value
+        self.block_count = 1
+        
+        #Find neighbors for seed
+        self.check_blocks([[current_seed]])
+        return self.touched
+
+    def claim_start(self, index, x, y, z):
+        '''Prepare x, y, z to become the starting block of seed index. A coded block that gets overwritten is taken off
+        total_blocks and stays with the seed that grew it, a rejected (-2) block is handed over to this seed.'''
+        value = self.matrix[x][y][z]
+        if value == -2:
+            for idx, blocks in enumerate(self.seed_blocks):
+                if idx != index and [x,y,z] in blocks:
+                    self.seed_blocks[idx] = [block for block in blocks if block != [x,y,z]]
+        elif value != -1:
+            self.total_blocks -= 1
+
+    def clear_seeds(self, indices):
+        '''Set the blocks grown by the given seeds back to -1 and empty their block lists.
+        Blocks that also belong to another seed (including its starting block) are left alone. Returns the old blocks.'''
+        protected = set()
+        for idx, blocks in enumerate(self.seed_blocks):
+            if idx not in indices:
+                protected.add(tuple(self.seeds[idx]))
+                protected.update(tuple(block) for block in blocks)
+        
+        old_blocks = []
+        for index in indices:
+            for block in self.seed_blocks[index]:
+                if tuple(block) in protected:
+                    continue
+                if self.matrix[block[0]][block[1]][block[2]] not in (-1, -2):
+                    self.total_blocks -= 1
+                self.matrix[block[0]][block[1]][block[2]] = -1
+            old_blocks += self.seed_blocks[index]
+            self.seed_blocks[index] = []
+        return old_blocks
+
+    def regrow_seed(self, index, location=None):
+        '''Clear the blocks grown by one seed (0 based index) and grow it again, optionally from a new [x,y,z] location.
+        Blocks of every other seed are left unchanged. Returns the region that needs to be exported again.'''
+        if location is None:
+            location = self.seeds[index]
+        x, y, z = location
+        
+        if self.check_model_range(x, y, z) == False:
+            raise ValueError("Seed coordinate %s, %s, %s is outside the model" %(x+1,y+1,z+1))
+        
+        if self.matrix[x][y][z] not in (-1, -2) and [x,y,z] not in self.seed_blocks[index]:
+            raise ValueError("Seed coordinate %s, %s, %s is already coded" %(x+1,y+1,z+1))
+        
+        old_blocks = self.clear_seeds([index])
+        self.claim_start(index, x, y, z)
+        
+        self.seeds[index] = [x,y,z]
+        self.seed_blocks[index] = self.grow_seed(x, y, z)
+        self.total_blocks += self.block_count
+        
+        self.summary += "Regrown seed %s value: %s\n" %(index+1,self.seed_value)
+        self.summary += "Block count: %s\n" %self.block_count
+        self.summary += "Seed coordinate: %s, %s, %s\n\n" %(x+1,y+1,z+1)
+        self.summary += "Total blocks coded: %s\n" %self.total_blocks
+        
+        return self.block_region(old_blocks + self.seed_blocks[index])
+
+    def regrow_region(self, min_row, max_row, min_col, max_col, min_lvl, max_lvl):
+        '''Regrow every seed whose starting block is inside a sub-volume (0 based, max values exclusive).
+        Each seed's old blocks are cleared wherever they are and it grows again from a new random location, confined
+        to the sub-volume. Blocks of every other seed, including any inside the sub-volume, are left unchanged.
+        Returns the region that needs to be exported again.'''
+        region = (max(min_row, 0), min(max_row, self.max_row), max(min_col, 0), min(max_col, self.max_col), max(min_lvl, 0), min(max_lvl, self.max_lvl))
+        if region[0] >= region[1] or region[2] >= region[3] or region[4] >= region[5]:
+            raise ValueError("Region %s does not overlap the model" %(region,))
+        
+        def in_region(block):
+            return region[0] <= block[0] < region[1] and region[2] <= block[1] < region[3] and region[4] <= block[2] < region[5]
+        
+        indices = [idx for idx, seed in enumerate(self.seeds) if in_region(seed)]
+        if not indices:
+            raise ValueError("No seeds start inside region %s" %(region,))
+        
+        old_blocks = self.clear_seeds(indices)
+        new_blocks = []
+        
+        #Temporarily shrink the model boundaries so check_model_range keeps growth inside the sub-volume
+        bounds = (self.min_row, self.max_row, self.min_col, self.max_col, self.min_lvl, self.max_lvl)
+        self.min_row, self.max_row, self.min_col, self.max_col, self.min_lvl, self.max_lvl = region
+        try:
+            for index in indices:
+                #New seeds can only start on blocks no other seed has coded
+                free = [[x,y,z] for x in xrange(region[0], region[1]) for y in xrange(region[2], region[3]) for z in xrange(region[4], region[5])
+                        if self.matrix[x][y][z] in (-1, -2)]
+                if not free:
+                    raise ValueError("Region %s has no uncoded blocks left to start seed %s" %(region, index+1))
+                x, y, z = random.choice(free)
+                self.claim_start(index, x, y, z)
+                
+                self.seeds[index] = [x,y,z]
+                self.seed_blocks[index] = self.grow_seed(x, y, z)
+                self.total_blocks += self.block_count
+                new_blocks += self.seed_blocks[index]
+                
+                self.summary += "Regrown seed %s value: %s\n" %(index+1,self.seed_value)
+                self.summary += "Block count: %s\n" %self.block_count
+                self.summary += "Seed coordinate: %s, %s, %s\n\n" %(x+1,y+1,z+1)
+        finally:
+            self.min_row, self.max_row, self.min_col, self.max_col, self.min_lvl, self.max_lvl = bounds
+            self.summary += "Total blocks coded: %s\n" %self.total_blocks
+        
+        return self.block_region(old_blocks + new_blocks)
+
+    def block_region(self, blocks):
+        '''Smallest region (min_row, max_row, min_col, max_col, min_lvl, max_lvl) containing the blocks, max values exclusive'''
+        rows = [block[0] for block in blocks]
+        cols = [block[1] for block in blocks]
+        lvls = [block[2] for block in blocks]
+        return (min(rows), max(rows)+1, min(cols), max(cols)+1, min(lvls), max(lvls)+1)
+
     def find_neighbors(self, row, col, lvl):
         '''Find blocks neighboring the current block (based on row, col, lvl) and see if they meet the criteria for coding.
         Selected blocks are then checked for neighbors that meet the coding criteria recursively.'''
@@ -174,6 +401,7 @@ class CreateModel():
                         self.matrix[row+i][col+j][lvl+k] = round(gauss,self.precision)
                         self.block_count += 1
                         neighborhood.append([row+i, col+j, lvl+k])
+                        self.touched.append([row+i, col+j, lvl+k])
                         
                         if self.deposit_type == 'vein':
                             if random.random() > 0.9:
@@ -181,6 +409,7 @@ class CreateModel():
                                 
                     else:
                         self.matrix[row+i][col+j][lvl+k] = -2
+                        self.touched.append([row+i, col+j, lvl+k])
         return neighborhood
 
     def check_blocks(self, neighborhoods):
@@ -295,41 +524,79 @@ class CreateModel():
         return pref_d, opp
                 
     
-    def write_matrix_csv(self):
-        '''Use this method to write a file representing the 2D matrix.'''
-        fileName = 'model.txt'
-        csv = open(fileName, 'w')
-        report = open('model_params.txt','w')        
-        for row_idx, row in enumerate(self.matrix):
-            for col_idx, col in enumerate(row):
-                for lvl_idx, value in enumerate(col): 
-                    csv.write(str(col_idx+1) + ',')
-                    csv.write(str(row_idx+1) + ',')
-                    csv.write(str(lvl_idx+1) + ',')
-                    csv.write('%0.3f' %value)
-                    if lvl_idx != len(col)-1:
-                        csv.write('\n')
-                if col_idx != len(row)-1:
-                    csv.write('\n')
-            csv.write('\n')
+    def write_matrix_csv(self, fileName=None, region=None):
+        '''Use this method to write a file representing the 2D matrix.
+        Pass the region returned by regrow_seed or regrow_region to only write the affected blocks.
+        A region is written to model_region.txt by default, with its report next to it, so model.txt is kept.'''
+        if region is None:
+            matrix_to_csv(self.matrix, fileName or 'model.txt', region)
+            self.write_report()
+        else:
+            fileName = fileName or 'model_region.txt'
+            matrix_to_csv(self.matrix, fileName, region)
+            self.write_report(os.path.splitext(fileName)[0] + '_params.txt')
+
+    def write_matrix_rle(self, fileName='model.rbm'):
+        '''Write the matrix as a compact binary file. Each column of levels is stored
+        as runs of (count, value) so the large areas of -1/-2 only take a few bytes.'''
+        counts = array.array(RLE_COUNT)
+        values = array.array(RLE_VALUE)
+        for row in self.matrix:
+            for col in row:
+                prev = None
+                count = 0
+                for value in col:
+                    if value == prev:
+                        count += 1
+                        continue
+                    if count:
+                        counts.append(count)
+                        values.append(prev)
+                    prev = value
+                    count = 1
+                if count:
+                    counts.append(count)
+                    values.append(prev)
+
+        if sys.byteorder != 'little':
+            counts.byteswap()
+            values.byteswap()
+
+        rle = open(fileName, 'wb')
+        rle.write(struct.pack(RLE_HEADER, RLE_MAGIC, RLE_VERSION, self.precision, self.max_row, self.max_col, self.max_lvl, len(counts)))
+        rle.write(counts.tostring())
+        rle.write(values.tostring())
+        rle.close()
+        self.write_report()
+
+    def write_report(self, fileName='model_params.txt'):
+        '''Write the model summary to model_params.txt'''
+        report = open(fileName,'w')        
         report.write(self.summary)
         print self.summary
         report.close()
-        csv.close()
 
-    def code_model(self, pcf, file15, item, reset):
-        '''Code the matrix values to the model if using a PCF'''
+    def code_model(self, pcf, file15, item, reset, region=None):
+        '''Code the matrix values to the model if using a PCF.
+        Pass the region returned by regrow_seed or regrow_region to only load the affected levels and tiles.
+        Uncoded blocks in a region are always reset so blocks cleared by the regrow are removed from the model item.'''
         summary = ""
         
         if not pcf or not file15 or not item:
             print "PCF, model, or items not defined..."
             return
         
-        for lvl in xrange(self.min_lvl+1, self.max_lvl+1):
-            m = model.Model(pcf, file15, lvl, lvl, self.min_row+1, self.max_row, self.min_col+1, self.max_col, [item])
+        if region is not None:
+            reset = True
+        else:
+            region = (self.min_row, self.max_row, self.min_col, self.max_col, self.min_lvl, self.max_lvl)
+        min_row, max_row, min_col, max_col, min_lvl, max_lvl = region
+        
+        for lvl in xrange(min_lvl+1, max_lvl+1):
+            m = model.Model(pcf, file15, lvl, lvl, min_row+1, max_row, min_col+1, max_col, [item])
             s = m.slab()
-            for col in xrange(self.min_col+1, self.max_col+1):
-                for row in xrange(self.min_row+1, self.max_row+1):
+            for col in xrange(min_col+1, max_col+1):
+                for row in xrange(min_row+1, max_row+1):
                     val = self.matrix[row-1][col-1][lvl-1]
                     if val != -1 and val != -2:
                         s.modset(item, lvl, row, col, val)  #store the value of the item at this location
@@ -456,6 +723,9 @@ You can also load directly to a 3DBM in MineSight using a PCF file.
         self.seed_y.Disable()
         self.seed_z.Disable()
         
+        #Output format
+        self.compact_output = wx.CheckBox(self.panel, label='Compact (RLE) output?')
+        
         self.starting_seeds = intctrl.IntCtrl(self.panel,value=int(self.params['Number of seeds']))
         self.chance_to_code = numctrl.NumCtrl(self.panel,integerWidth= 10, fractionWidth= 3, min= 0, max=1, value=self.params['Expansion probability'])
         self.average = numctrl.NumCtrl(self.panel,integerWidth= 10, fractionWidth= 2, min= 0, value=self.params['Average grade'])
@@ -526,6 +796,8 @@ You can also load directly to a 3DBM in MineSight using a PCF file.
         self.gridSizer.Add(self.seed_z_desc, pos=(3,2), span=(1,1), flag=wx.EXPAND | wx.ALL)
         self.gridSizer.Add(self.seed_z, pos=(3,3), span=(1,1), flag=wx.ALL)        
 
+        self.gridSizer.Add(self.compact_output, pos=(4,2), span=(1,2), flag=wx.ALL)
+
         self.staticSizer3.Add(self.gridSizer)
 
         #Run and Close buttons
@@ -661,7 +933,10 @@ You can also load directly to a 3DBM in MineSight using a PCF file.
         if self.use_pcf_checkbox.GetValue() == True:
             matrix.code_model(self.FILE10.path(), self.FILE15, self.ITEM, self.reset_item_checkbox.GetValue())
         
-        matrix.write_matrix_csv()
+        if self.compact_output.GetValue() == True:
+            matrix.write_matrix_rle()
+        else:
+            matrix.write_matrix_csv()
         
         print "Done"
         dial = wx.MessageBox(matrix.summary + '\n\nCLOSE?','Info', wx.YES_NO | wx.ICON_INFORMATION)